@@ -1,4 +1,11 @@
+import copy
+import functools
+import os
 import pathlib
+import re
+import threading
+import time
+from collections import OrderedDict
 from configparser import ConfigParser
 
 import bottle
@@ -14,8 +21,15 @@ class BadUserspaceError(UserAppException):
     pass
 
 
+class BadConfigurationError(UserAppException):
+    pass
+
+
 VERSION = "0.9.6"
 
+DEFAULT_SESSION_CACHE_TTL = 10.0  # seconds
+DEFAULT_SESSION_CACHE_SIZE = 4096
+
 
 DEFAULT_LOGIN_HTML = """
 <!DOCTYPE html>
@@ -65,13 +79,284 @@ DEFAULT_ERROR_HTML = """
 """
 
 
+def _split_template(template, nfields):
+    """
+    Split a str.format() template around its positional fields {0} to
+    {nfields-1}, so that it can be rendered by plain concatenation.
+
+    Returns a tuple of nfields+1 parts, or None if the fields don't
+    appear once each and in order, or if there are any other braces in
+    the template, in which case it must be rendered with str.format().
+    """
+    parts = []
+    for i in range(nfields):
+        head, sep, template = template.partition("{%d}" % i)
+        parts.append(head)
+        if not sep:
+            return None
+    parts.append(template)
+    if any("{" in part or "}" in part for part in parts):
+        return None
+    return tuple(parts)
+
+
+_SECTION_RE = re.compile(r"\[(?P<name>[^\]]+)\]")
+_OPTION_RE = re.compile(r"(?P<key>[^=:\s][^=:]*?)\s*[=:]\s*(?P<value>.*)")
+
+
+def _parse_config(lines):
+    """
+    Parse the lines of an .ini configuration into a dict of dicts.
+
+    Only the subset of the format that an Odre configuration needs is
+    understood: section headers, 'key = value' or 'key: value' options,
+    blank lines and comments. If anything else is found, e.g. continuation
+    lines or a [DEFAULT] section, None is returned.
+    """
+    config = {}
+    section = None
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped[0] in "#;":
+            continue
+        if line[0].isspace():  # continuation line
+            return None
+        m = _SECTION_RE.fullmatch(stripped)
+        if m:
+            name = m["name"]
+            if name == "DEFAULT" or name in config:
+                return None
+            section = config[name] = {}
+            continue
+        m = _OPTION_RE.fullmatch(stripped)
+        if m is None or section is None:
+            return None
+        key = m["key"].lower()
+        if key in section:
+            return None
+        section[key] = m["value"]
+    return config
+
+
+def _read_config(lines):
+    """
+    Read an .ini configuration from an iterable yielding strings into a
+    ConfigParser, parsing it with _parse_config() if possible, which is
+    faster than ConfigParser.read_file().
+    """
+    lines = list(lines)
+    config = _parse_config(lines)
+    cp = ConfigParser(interpolation=None)
+    if config is None:
+        cp.read_file(lines)
+    else:
+        cp.read_dict(config)
+    return cp
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_config_file(path, mtime_ns):
+    """
+    Parse the configuration file 'path' with _parse_config(). The result
+    is cached by path and modification time, so it must not be modified.
+    """
+    with path.open() as cf:
+        return _parse_config(cf)
+
+
+def _opt_path(section, key):
+    """Return the optional path 'key' of the config section, or None"""
+    value = section.get(key)
+    return pathlib.Path(value) if value else None
+
+
+def _cookie_options(section):
+    """
+    Return the keyword arguments for bottle's set_cookie() given by the
+    cookie_* keys of the [app] config section. Options that aren't given
+    are left to bottle's defaults.
+    """
+    opts = {}
+    path = section.get("cookie_path")
+    if path:
+        opts["path"] = path
+    samesite = section.get("cookie_samesite")
+    if samesite:
+        if samesite.lower() not in ("lax", "strict", "none"):
+            raise BadConfigurationError(
+                f"cookie_samesite must be lax, strict or none. Got '{samesite}'"
+            )
+        opts["samesite"] = samesite.lower()
+    for flag in ("secure", "httponly"):
+        value = section.get(f"cookie_{flag}")
+        if value:
+            if value.lower() not in ConfigParser.BOOLEAN_STATES:
+                raise BadConfigurationError(
+                    f"cookie_{flag} must be a boolean. Got '{value}'"
+                )
+            opts[flag] = ConfigParser.BOOLEAN_STATES[value.lower()]
+    max_age = section.get("cookie_max_age")
+    if max_age:
+        try:
+            opts["max_age"] = int(max_age)
+        except ValueError:
+            raise BadConfigurationError(
+                f"cookie_max_age must be a number of seconds. Got '{max_age}'"
+            ) from None
+    return opts
+
+
+def _cache_options(section):
+    """
+    Return the (ttl, size) of the session cache given by the
+    session_cache_ttl and session_cache_size keys of the [app] config
+    section. Keys that aren't given take their defaults.
+    """
+    ttl, size = DEFAULT_SESSION_CACHE_TTL, DEFAULT_SESSION_CACHE_SIZE
+    value = section.get("session_cache_ttl")
+    if value:
+        try:
+            ttl = float(value)
+        except ValueError:
+            ttl = None
+        if ttl is None or not ttl >= 0:  # also rejects nan
+            raise BadConfigurationError(
+                f"session_cache_ttl must be a number of seconds. Got '{value}'"
+            )
+    value = section.get("session_cache_size")
+    if value:
+        try:
+            size = int(value)
+        except ValueError:
+            size = None
+        if size is None or size < 0:
+            raise BadConfigurationError(
+                f"session_cache_size must be a number of entries. Got '{value}'"
+            )
+    return ttl, size
+
+
+# session keys are checked against this before querying the userspace
+_SESSION_KEY_RE = re.compile(r"[A-Za-z0-9+/=_.-]{8,128}")
+
+_LOGIN_FIELDS = (("username", ""), ("password", ""), ("proceed", "/"))
+_CHANGE_PASSWORD_FIELDS = (
+    ("oldpassword", ""),
+    ("newpassword1", ""),
+    ("newpassword2", ""),
+)
+
+# body of failed json logins, which doesn't echo the username back
+_BAD_CREDENTIALS = "Bad credentials"
+
+# body of successful logins without a cookie, copied for each response
+_TOKEN_BODY = {"rc": 200, "text": "OK", "token_type": "Bearer", "access_token": None}
+
+_LOGIN_PREFIX, _LOGIN_SUFFIX = _split_template(DEFAULT_LOGIN_HTML, 1)
+_ERROR_PREFIX, _ERROR_INFIX, _ERROR_SUFFIX = _split_template(DEFAULT_ERROR_HTML, 2)
+
+
+class _TTLCache:
+    """
+    Small thread-safe LRU mapping whose entries expire after 'ttl'
+    seconds. At most 'maxsize' entries are kept, the least recently
+    used being evicted first. A ttl or a maxsize of 0 disables the cache.
+    """
+
+    __slots__ = ("ttl", "maxsize", "_data", "_lock")
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value cached for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expiry, value = entry
+            if expiry < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Cache value under key for the next 'ttl' seconds"""
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Remove key from the cache and return its value, if fresh"""
+        with self._lock:
+            expiry, value = self._data.pop(key, (0, None))
+        return value if expiry >= time.monotonic() else None
+
+    def discard_if(self, predicate):
+        """Remove every entry whose value satisfies predicate(value)"""
+        with self._lock:
+            stale = [k for k, (_, v) in self._data.items() if predicate(v)]
+            for k in stale:
+                del self._data[k]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class _ShardedTTLCache:
+    """
+    _TTLCache split in 'nshards' independently locked shards, selected by
+    the hash of the key, so that concurrent requests seldom wait on each
+    other. 'nshards' must be a power of two; fewer shards are used when
+    'maxsize' is smaller, so that no more than 'maxsize' entries are kept.
+    """
+
+    __slots__ = ("_shards", "_mask")
+
+    def __init__(self, ttl, maxsize, nshards=16):
+        while nshards > 1 and nshards > maxsize:
+            nshards //= 2
+        shard_size = maxsize // nshards
+        self._shards = [_TTLCache(ttl, shard_size) for _ in range(nshards)]
+        self._mask = nshards - 1
+
+    def _shard(self, key):
+        return self._shards[hash(key) & self._mask]
+
+    def get(self, key):
+        return self._shard(key).get(key)
+
+    def put(self, key, value):
+        self._shard(key).put(key, value)
+
+    def pop(self, key):
+        return self._shard(key).pop(key)
+
+    def discard_if(self, predicate):
+        for shard in self._shards:
+            shard.discard_if(predicate)
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
+
 class Odre(bottle.Bottle):
     """
     Web Application class derived from Bottle that includes user
     authentication based on the pgusers module.
 
-    All Odre instances include a /login route that performs the
-    user authentication.
+    Once configured, Odre instances include a /login route that performs
+    the user authentication, as well as /logout and /changepassword.
 
     The class also provides an 'authenticated' decorator to do the
     authentication automatically, e.g:
@@ -98,23 +383,24 @@ class Odre(bottle.Bottle):
         conf = kwargs.pop("config", None)
 
         super().__init__(*args, **kwargs)
-        self.route("/login", method="POST", callback=self.post_login)
-        self.route("/logout", method="POST", callback=self.post_logout)
-        self.route("/changepassword", method="POST", callback=self.post_change_password)
+        self._auth_routes_installed = False
 
         if isinstance(conf, ConfigParser):
             cp = conf
         elif isinstance(conf, str):  # conf is a filename
-            cp = ConfigParser()
             p = pathlib.Path(conf)
-            with p.open() as cf:
-                cp.read_file(cf)
+            config = _parse_config_file(p, p.stat().st_mtime_ns)
+            cp = ConfigParser(interpolation=None)
+            if config is not None:
+                cp.read_dict(config)
+            else:
+                with p.open() as cf:
+                    cp.read_file(cf)
         elif conf is not None:
             # conf is a file like object or iterable yielding strings
-            cp = ConfigParser()
-            cp.read_file(conf)
+            cp = _read_config(conf)
 
-        if cp:
+        if cp is not None:
             self.configure(cp)
 
     def configure(self, cp):
@@ -127,46 +413,137 @@ class Odre(bottle.Bottle):
         appsection = cp["app"]
         self.appname = appsection["name"]
         self.cookie_name = appsection.get("cookie_name", None)
+        self._cookie_opts = _cookie_options(appsection)
+        cache_ttl, cache_size = _cache_options(appsection)
         self.root_dir = pathlib.Path(appsection["root_dir"])
-        self.login_page = None
-        lf = appsection.get("login_page")
-        if lf:
-            self.login_page = pathlib.Path(lf)
-        self.bad_credentials_page = None
-        ep = appsection.get("bad_credentials_page")
-        if ep:
-            self.bad_credentials_page = pathlib.Path(ep)
-
-        database = cp["database"]
-        userspace = cp["userspace"]
-        usname = userspace["name"]
+        self.login_page = _opt_path(appsection, "login_page")
+        self.bad_credentials_page = _opt_path(appsection, "bad_credentials_page")
+        self._page_cache = {}
+
+        database = dict(cp["database"])
+        usname = cp["userspace"]["name"]
         self.userspace = UserSpace(usname, **database)
+        self._check_key = self.userspace.check_key
+        self._validate_user = self.userspace.validate_user
+        self._session_cache = _ShardedTTLCache(cache_ttl, cache_size)
+        self._rejected_cache = _ShardedTTLCache(cache_ttl, cache_size)
+        self._user_cache = _TTLCache(cache_ttl, cache_size)
 
         self.config = cp
+        self._install_auth_routes()
+
+    def _install_auth_routes(self):
+        """
+        Add the /login, /logout and /changepassword routes, which need a
+        userspace, the first time the app is configured. Routes that the
+        app already has for the same rule and method are left alone, as
+        they would otherwise be replaced by these ones.
+        """
+        if self._auth_routes_installed:
+            return
+        routed = {(route.rule, route.method) for route in self.routes}
+        for rule, callback in (
+            ("/login", self.post_login),
+            ("/logout", self.post_logout),
+            ("/changepassword", self.post_change_password),
+        ):
+            if (rule, "POST") not in routed:
+                self.route(rule, method="POST", callback=callback)
+        self._auth_routes_installed = True
+
+    def _get_request(self):
+        """
+        Return the request being served, bottle.request unless overridden
+        """
+        return bottle.request
+
+    def _get_request_fields(self, fields):
+        """
+        Get the values of the fields posted in the request, either as a
+        json object or as a form, depending on the content type.
+
+        Args:
+        fields - sequence of (name, default) pairs
+
+        Returns a tuple (json_used, values) with values in the same order
+        as fields.
+        """
+        req = self._get_request()
+        # the same test bottle makes before parsing request.json
+        media_type = req.content_type.split(";", 1)[0].strip()
+        json_used = media_type == "application/json"
+        if json_used:
+            source = req.json or {}
+        else:
+            # decode() gives the values as utf-8, not bottle's default latin-1
+            source = req.forms.decode()
+        return json_used, [source.get(name, default) for name, default in fields]
 
     def _get_session_key(self):
         """
-        Get the session key from the request
+        Get the session key from the request, or "" if there is none or
+        it can't be a valid key, which saves a database query.
         """
-        key = ""
+        req = self._get_request()
         if self.cookie_name:
-            key = bottle.request.cookies.get(self.cookie_name)
+            key = req.cookies.get(self.cookie_name) or ""
         else:
-            auth_hdr = bottle.request.headers.get("Authorization", "")
-            if auth_hdr.startswith("Bearer"):
-                key = auth_hdr.split(" ")[1]
-        return key
+            # straight from the environ, without building bottle's headers view
+            auth_hdr = req.environ.get("HTTP_AUTHORIZATION", "")
+            key = auth_hdr[7:].strip() if auth_hdr.startswith("Bearer ") else ""
+        return key if _SESSION_KEY_RE.fullmatch(key) else ""
 
     def _get_session_data(self):
         """
         Get the data associated to the session: username, userid, and
-        any extra data associated to the session
+        any extra data associated to the session.
+
+        Sessions are cached for 'session_cache_ttl' seconds so that
+        repeated requests don't hit the database every time. Rejected
+        keys are cached too, apart, so they can't evict valid sessions.
         """
         key = self._get_session_key()
         if key:
-            return self.userspace.check_key(key)
+            session = self._session_cache.get(key) or self._rejected_cache.get(key)
+            if session is None:
+                session = self._check_key(key)
+                if session[0] == OK:
+                    self._session_cache.put(key, session)
+                else:
+                    self._rejected_cache.put(key, session)
+            return session
         return NOT_FOUND, "", 0, None
 
+    def _render_page(self, path, *values):
+        """
+        Render the html template 'path' with values as its positional
+        fields, or return None if it can't be read or is empty.
+
+        Templates are kept in memory, split around their fields so that
+        rendering is a concatenation, and only read again when the
+        modification time of the file changes.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            cache_key = (path, len(values))
+            cached = self._page_cache.get(cache_key)
+            if not (cached and cached[0] == mtime):
+                with path.open() as fd:
+                    text = fd.read()
+                parts = _split_template(text, len(values))
+                cached = self._page_cache[cache_key] = (mtime, text, parts)
+        except OSError:
+            return None
+        _, text, parts = cached
+        if not text:
+            return None
+        if parts is None:
+            return text.format(*values)
+        rendered = [parts[0]]
+        for value, part in zip(values, parts[1:]):
+            rendered += (str(value), part)
+        return "".join(rendered)
+
     def authenticated(self, callback):
         """
         Decorator that checks whether the user is authenticated.
@@ -177,24 +554,39 @@ class Odre(bottle.Bottle):
         If not valid, the login method is called.
         """
 
+        # methods are looked up once here rather than on every request;
+        # the userspace is not, as configure() may replace it later
+        get_session_data = self._get_session_data
+        get_request = self._get_request
+        login = self.login
+
+        @functools.wraps(callback)
         def wrapper(*args, **kwargs):
-            (rc, uname, uid, data) = self._get_session_data()
-            if rc == OK:
+            if get_session_data()[0] == OK:
                 return callback(*args, **kwargs)
 
-            path_info = bottle.request.environ.get("PATH_INFO")
-            return self.login(path_info)
+            return login(get_request().path)
 
         return wrapper
 
     def get_user_data(self):
         """
-        Find data about a the session user
+        Find data about a the session user.
+
+        User records are cached by userid for 'session_cache_ttl' seconds.
+        Each call returns its own copy of the session data, so the cached
+        session isn't changed by callers modifying it.
         """
         rc, uname, uid, session_data = self._get_session_data()
         if rc == OK:
-            udata = self.userspace.find_user(userid=uid)
-            udata["session_data"] = session_data
+            udata = self._user_cache.get(uid)
+            if udata is None:
+                udata = self.userspace.find_user(userid=uid)
+                if udata is None:
+                    return None
+                self._user_cache.put(uid, udata)
+            udata = dict(udata)
+            udata["session_data"] = copy.deepcopy(session_data)
             return udata
 
         return None
@@ -205,14 +597,14 @@ class Odre(bottle.Bottle):
         The login page should contain a form with the fields
         "username", "password", and the hidden field "proceed", which
         is the relative URL to go once the authentication is successful.
+        The path is html-escaped before being put in the page.
         """
-        if self.login_page and self.login_page.is_file():
-            with self.login_page.open() as lp:
-                loginhtml = lp.read()
-        else:
-            loginhtml = DEFAULT_LOGIN_HTML
+        path = bottle.html_escape(str(path))
+        loginhtml = self.login_page and self._render_page(self.login_page, path)
+        if loginhtml:
+            return loginhtml
 
-        return loginhtml.format(path)
+        return _LOGIN_PREFIX + path + _LOGIN_SUFFIX
 
     def post_login(self, extra=None):
         """
@@ -221,26 +613,17 @@ class Odre(bottle.Bottle):
         Extracts the fields username, password and proceed, does the
         authentication and, if successful, redirects to proceed.
         """
-        content_type = bottle.request.headers["Content-type"]
-
-        if content_type == "application/json":
-            json_used = True
-            jsn = bottle.request.json
-            username = jsn.get("username", "")
-            password = jsn.get("password", "")
-            proceed = jsn.get("proceed", "/")
-        else:
-            json_used = False
-            username = bottle.request.forms.get("username", "")
-            password = bottle.request.forms.get("password", "")
-            proceed = bottle.request.forms.get("proceed", "/")
+        json_used, (username, password, proceed) = self._get_request_fields(
+            _LOGIN_FIELDS
+        )
 
-        our_host = bottle.request.environ.get("HTTP_HOST", "localhost")
-        our_protocol = bottle.request.get("wsgi.url_scheme", "http")
+        environ = self._get_request().environ
+        our_host = environ.get("HTTP_HOST", "localhost")
+        our_protocol = environ.get("wsgi.url_scheme", "http")
         # if behind reverse proxy, get the headers
-        forwarded_protocol = bottle.request.environ.get("HTTP_X_FORWARDED_PROTO", "")
-        forwarded_host = bottle.request.environ.get("HTTP_X_FORWARDED_HOST", "")
-        forwarded_port = bottle.request.environ.get("HTTP_X_FORWARDED_PORT", "")
+        forwarded_protocol = environ.get("HTTP_X_FORWARDED_PROTO", "")
+        forwarded_host = environ.get("HTTP_X_FORWARDED_HOST", "")
+        forwarded_port = environ.get("HTTP_X_FORWARDED_PORT", "")
 
         the_host = forwarded_host or our_host
         the_protocol = forwarded_protocol or our_protocol
@@ -253,54 +636,57 @@ class Odre(bottle.Bottle):
 
         target = f"{the_protocol}://{the_host}{the_port}{proceed}"
 
-        key, admin, uid = self.userspace.validate_user(username, password, extra)
-        if key and self.cookie_name:
-            bottle.response.set_cookie(self.cookie_name, key)
-            bottle.redirect(target)
-
-        if key:
-            return dict(rc=200, text="OK", token_type="Bearer", access_token=key)
-        if json_used:
-            raise bottle.HTTPError(
-                status=401, body=f"Bad credentials for user '{username}'"
+        key, admin, uid = self._validate_user(username, password, extra)
+        if not key:
+            if json_used:
+                raise bottle.HTTPError(status=401, body=_BAD_CREDENTIALS)
+            username = bottle.html_escape(username)
+            proceed = bottle.html_escape(proceed)
+            error_html = self.bad_credentials_page and self._render_page(
+                self.bad_credentials_page, username, proceed
             )
-        else:
-            if not self.bad_credentials_page:
-                error_html = DEFAULT_ERROR_HTML.format(username, proceed)
-            else:
-                with self.bad_credentials_page.open() as fd:
-                    error_html = fd.read().format(username, proceed)
-            return error_html
+            if error_html:
+                return error_html
+            return _ERROR_PREFIX + username + _ERROR_INFIX + proceed + _ERROR_SUFFIX
+
+        # a copy, as pgusers stores it, unaffected by later changes to extra
+        self._session_cache.put(key, (OK, username, uid, copy.deepcopy(extra)))
+        if self.cookie_name:
+            bottle.response.set_cookie(self.cookie_name, key, **self._cookie_opts)
+            bottle.redirect(target)
+        body = _TOKEN_BODY.copy()
+        body["access_token"] = key
+        return body
 
     def post_logout(self):
-        """callback for the /logout route"""
-        _, _, uid, _ = self._get_session_data()
+        """
+        callback for the /logout route
+
+        A cached session is taken out of the cache, so check_key is only
+        called for sessions this process hasn't seen recently.
+        """
+        key = self._get_session_key()
+        uid = None
+        if key:
+            session = self._session_cache.pop(key) or self._check_key(key)
+            uid = session[2]
         if uid:
             self.userspace.kill_sessions(uid)
+            self._session_cache.discard_if(lambda session: session[2] == uid)
+            self._user_cache.pop(uid)
 
         if self.cookie_name:
-            bottle.response.delete_cookie(self.cookie_name)
+            bottle.response.delete_cookie(self.cookie_name, **self._cookie_opts)
         bottle.redirect("/")
 
     def post_change_password(self):
         """callback for the /changepassword route"""
-        content_type = bottle.request.headers["Content-type"]
-
-        if content_type == "application/json":
-            json_used = True
-            jsn = bottle.request.json
-            oldpassword = jsn.get("oldpassword", "")
-            newpassword1 = jsn.get("newpassword1", "")
-            newpassword2 = jsn.get("newpassword2", "")
-        else:
-            json_used = False
-            oldpassword = bottle.request.forms.get("oldpassword", "")
-            newpassword1 = bottle.request.forms.get("newpassword1", "")
-            newpassword2 = bottle.request.forms.get("newpassword2", "")
+        json_used, fields = self._get_request_fields(_CHANGE_PASSWORD_FIELDS)
+        oldpassword, newpassword1, newpassword2 = fields
 
-        rc, username, userid, _ = self._get_session_data()
+        rc, _, userid, _ = self._get_session_data()
         if rc != OK:
-            self.post_logout()
+            return self.post_logout()
 
         if newpassword1 != newpassword2:
             raise bottle.HTTPError(status=400, body="New passwords don't match")
@@ -310,6 +696,7 @@ class Odre(bottle.Bottle):
             raise bottle.HTTPError(status=401, body="Bad old password")
 
         if rc == NOT_FOUND:
-            self.post_logout()
+            return self.post_logout()
 
+        self._user_cache.pop(userid)
         return dict(rc=200, text="OK", message="Password changed")